@@ -6,4 +6,5 @@ RANDOM_SEED = 0
 LEARNING_RATE_STEP = 4e-6
 LRRT_STOP_PATIENCE = 5
 LRRT_STOP_FACTOR = 4
-LRRT_LOSS_MIN_DELTA = 0.1
\ No newline at end of file
+LRRT_LOSS_MIN_DELTA = 0.1
+MAX_BUFFER_SIZE = 1024
\ No newline at end of file
@@ -43,36 +43,26 @@ class RandomScale(tf.keras.layers.Layer):
 
     @tf.function
     def call(self, image):
-        [red, green, blue] = tf.unstack(image, axis=-1)
+        # reduce the red and green channels at once
+        xy = image[..., :2]
+        blue = image[..., 2:]
+
+        maxs = tf.reduce_max(xy, axis=-2, keepdims=True)
+        mins = tf.reduce_min(xy, axis=-2, keepdims=True)
+        mids = (maxs + mins) / 2
+        alphas_1 = (self.min_value - mids) / (mins - mids)
+        alphas_2 = (self.max_value - mids) / (maxs - mids)
+        max_alpha = self.round_down_float_to_1_decimal(
+            tf.reduce_min(tf.minimum(alphas_1, alphas_2)))
 
-        red_maxs = tf.reduce_max(red, axis=-1, keepdims=True)
-        red_mins = tf.reduce_min(red, axis=-1, keepdims=True)
-        red_mids = (red_maxs + red_mins) / 2
-        red_alphas_1 = (self.min_value - red_mids) / (red_mins - red_mids)
-        red_alphas_2 = (self.max_value - red_mids) / (red_maxs - red_mids)
-        red_alpha = self.round_down_float_to_1_decimal(
-            tf.reduce_min([red_alphas_1, red_alphas_2]))
-
-        green_maxs = tf.reduce_max(green, axis=-1, keepdims=True)
-        green_mins = tf.reduce_min(green, axis=-1, keepdims=True)
-        green_mids = (green_maxs + green_mins) / 2
-        green_alphas_1 = (self.min_value - green_mids) / \
-            (green_mins - green_mids)
-        green_alphas_2 = (self.max_value - green_mids) / \
-            (green_maxs - green_mids)
-        green_alpha = self.round_down_float_to_1_decimal(
-            tf.reduce_min([green_alphas_1, green_alphas_2]))
-
-        max_alpha = tf.reduce_min([red_alpha, green_alpha])
         alpha = tf.random.uniform(
             shape=[], minval=0.5, maxval=max_alpha, seed=self.seed)
-        new_red = alpha * (red - red_mids) + red_mids
-        new_green = alpha * (green - green_mids) + green_mids
+        new_xy = alpha * (xy - mids) + mids
 
         if self.debug:
             tf.print("scale", alpha)
 
-        return tf.stack([new_red, new_green, blue], axis=-1)
+        return tf.concat([new_xy, blue], axis=-1)
 
 
 class RandomShift(tf.keras.layers.Layer):
@@ -85,32 +75,24 @@ class RandomShift(tf.keras.layers.Layer):
 
     @tf.function
     def call(self, image):
-        [red, green, blue] = tf.unstack(image, axis=-1)
+        # shift the red and green channels at once
+        xy = image[..., :2]
+        blue = image[..., 2:]
 
-        left_offset = tf.reduce_min(red) - self.min_value
-        right_offset = self.max_value - tf.reduce_max(red)
-        red_shift = tf.random.uniform(shape=[],
-                                      minval=tf.math.negative(left_offset),
-                                      maxval=right_offset,
-                                      seed=self.seed)
+        flat_xy = tf.reshape(xy, [-1, 2])
+        min_offsets = tf.reduce_min(flat_xy, axis=0) - self.min_value
+        max_offsets = self.max_value - tf.reduce_max(flat_xy, axis=0)
+        rand = tf.random.uniform(shape=[], seed=self.seed)
+        shifts = tf.math.negative(min_offsets) + \
+            rand * (max_offsets + min_offsets)
 
         if self.debug:
-            tf.print("red shift", red_shift)
-
-        bottom_offset = tf.reduce_min(green) - self.min_value
-        top_offset = self.max_value - tf.reduce_max(green)
-        green_shift = tf.random.uniform(shape=[],
-                                        minval=tf.math.negative(bottom_offset),
-                                        maxval=top_offset,
-                                        seed=self.seed)
+            tf.print("red shift", shifts[0])
+            tf.print("green shift", shifts[1])
 
-        new_red = tf.add(red, red_shift)
-        new_green = tf.add(green, green_shift)
+        new_xy = tf.add(xy, shifts)
 
-        if self.debug:
-            tf.print("green shift", green_shift)
-
-        return tf.stack([new_red, new_green, blue], axis=-1)
+        return tf.concat([new_xy, blue], axis=-1)
 
 
 class RandomRotation(tf.keras.layers.Layer):
@@ -157,6 +139,11 @@ class RandomFlip(tf.keras.layers.Layer):
         self.seed = seed
         self.debug = debug
 
+        # the flipped channel is fixed by the mode,
+        # so only its branch is traced
+        self.flip_horizontal = mode == 'horizontal'
+        self.flip_vertical = mode == 'vertical'
+
     @tf.function
     def call(self, image):
         rand = tf.random.uniform(shape=[],
@@ -164,16 +151,16 @@ class RandomFlip(tf.keras.layers.Layer):
                                  maxval=1.,
                                  seed=self.seed)
         [red, green, blue] = tf.unstack(image, axis=-1)
-        flip_horizontal = tf.logical_and(
-            rand > 0.5, tf.equal(self.mode, 'horizontal'))
-        flip_vertical = tf.logical_and(
-            rand > 0.5, tf.equal(self.mode, 'vertical'))
         add_factor = (self.min_value +
                       (self.max_value - self.min_value) / 2) * 2
-        new_red = tf.cond(
-            flip_horizontal, lambda: tf.add(-red, add_factor), lambda: red)
-        new_green = tf.cond(
-            flip_vertical, lambda: tf.add(-green, add_factor), lambda: green)
+        new_red = red
+        new_green = green
+        if self.flip_horizontal:
+            new_red = tf.cond(
+                rand > 0.5, lambda: tf.add(-red, add_factor), lambda: red)
+        if self.flip_vertical:
+            new_green = tf.cond(
+                rand > 0.5, lambda: tf.add(-green, add_factor), lambda: green)
 
         if self.debug:
             tf.print("flip", rand)
@@ -109,7 +109,8 @@ def generate_dataset(dataframe, training=False, video_ids=[],
     # preprocess the source dataframe
     dataframe = preprocess_dataframe(dataframe,
                                      with_root=True,
-                                     with_midhip=True)
+                                     with_midhip=True,
+                                     filter_video_ids=video_ids)
 
     # retrieve the tree path
     _, _, tree_path = tssi_v2()
@@ -4,150 +4,184 @@ import pandas as pd
 from mediapipe.python.solutions.pose import PoseLandmark
 
 
-def preprocess_dataframe(dataframe, with_root=True, with_midhip=False):
-    x_columns = dataframe.columns[3::2]
-    y_columns = dataframe.columns[4::2]
-    xy_columns = dataframe.columns[3:]
+def split_dataframe(dataframe):
+    # split the info columns (video, frame, label)
+    # from the coordinates, which are returned as a float32 array
+    info = dataframe.iloc[:, :3]
+    columns = dataframe.columns[3:]
+    data = dataframe.iloc[:, 3:].to_numpy(dtype=np.float32, copy=True)
+    return info, data, columns
+
+
+def join_dataframe(info, data, columns):
+    # rebuild a dataframe from the info columns
+    # and the array of coordinates
+    coordinates = pd.DataFrame(data, columns=columns, index=info.index)
+    return pd.concat([info, coordinates], axis=1)
+
+
+def get_column_indices(columns, selected_columns):
+    # positions of the selected columns,
+    # raising KeyError if any of them is missing
+    indices = columns.get_indexer_for(selected_columns)
+    if (indices < 0).any():
+        missing = [column for column, index in zip(
+            selected_columns, indices) if index < 0]
+        raise KeyError(f"{missing} not in columns")
+    return indices
+
+
+def compute_midpoint(data, columns, first_joint, second_joint):
+    first = data[:, get_column_indices(
+        columns, [first_joint + '_x', first_joint + '_y'])]
+    second = data[:, get_column_indices(
+        columns, [second_joint + '_x', second_joint + '_y'])]
+    return (first + second) / 2.
+
+
+def add_root_and_midhip(data, columns, root, midhip):
+    # append the (uncentered) root and midhip columns
+    if root is not None:
+        data = np.concatenate([data, root], axis=1)
+        columns = columns.append(pd.Index(['root_x', 'root_y']))
+    if midhip is not None:
+        data = np.concatenate([data, midhip], axis=1)
+        columns = columns.append(pd.Index(['midhip_x', 'midhip_y']))
+    return data, columns
+
+
+def replace_nan_with_other_columns(data, data_columns, column_groups):
+    # replace the rows where all the columns of a group are nan
+    # with the tiled values of the other columns of the group
+    for columns, other_columns in column_groups:
+        indices = get_column_indices(data_columns, columns)
+        other_indices = get_column_indices(data_columns, other_columns)
+        mask = np.all(np.isnan(data[:, indices]), axis=1)
+        repetitions = int(len(columns) / len(other_columns))
+        data[np.ix_(mask, indices)] = np.tile(
+            data[np.ix_(mask, other_indices)], repetitions)
+
+
+def scale_by_max_per_video(data, videos):
+    # divide the coordinates of each video by its maximum
+    # absolute value (ignoring nan), assuming the rows
+    # of each video are contiguous
+    # NOTE: there is nothing to scale if no video is left
+    # (e.g. the filter matched none), and reduceat fails then
+    if len(videos) == 0:
+        return
+    starts = np.flatnonzero(np.r_[True, videos[1:] != videos[:-1]])
+    video_lengths = np.diff(np.r_[starts, len(videos)])
+    max_per_row = np.fmax.reduce(np.abs(data), axis=1)
+    max_per_video = np.fmax.reduceat(max_per_row, starts)
+    data /= np.repeat(max_per_video, video_lengths)[:, np.newaxis]
+
+
+def preprocess_dataframe(dataframe, with_root=True, with_midhip=False,
+                         filter_video_ids=[]):
+    # filter the videos before doing any work on them
+    if len(filter_video_ids) > 0:
+        dataframe = dataframe[dataframe["video"].isin(filter_video_ids)]
+
+    info, data, xy_columns = split_dataframe(dataframe)
     left_hand_columns = [
-        column for column in dataframe.columns if "leftHand" in column]
+        column for column in xy_columns if "leftHand" in column]
     right_hand_columns = [
-        column for column in dataframe.columns if "rightHand" in column]
+        column for column in xy_columns if "rightHand" in column]
     left_wrist_columns = ['leftHand_' + str(int(PoseLandmark.LEFT_WRIST)) +
                           '_x', 'leftHand_' + str(int(PoseLandmark.LEFT_WRIST)) + '_y']
     right_wrist_columns = ['rightHand_' + str(int(PoseLandmark.RIGHT_WRIST)) +
                            '_x', 'rightHand_' + str(int(PoseLandmark.RIGHT_WRIST)) + '_y']
-    face_columns = [column for column in dataframe.columns if "face" in column]
+    face_columns = [column for column in xy_columns if "face" in column]
     nose_columns = ["pose_0_x", "pose_0_y"]
 
-    # Add root column
-    if with_root:
-        dataframe['root_x'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_SHOULDER)) + '_x'] +
-                               dataframe['pose_' + str(int(PoseLandmark.RIGHT_SHOULDER)) + '_x']) / 2.
-        dataframe['root_y'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_SHOULDER)) + '_y'] +
-                               dataframe['pose_' + str(int(PoseLandmark.RIGHT_SHOULDER)) + '_y']) / 2.
-
-    # Add midhip column
-    if with_midhip:
-        dataframe['midhip_x'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_HIP)) + '_x'] +
-                                 dataframe['pose_' + str(int(PoseLandmark.RIGHT_HIP)) + '_x']) / 2.
-        dataframe['midhip_y'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_HIP)) + '_y'] +
-                                 dataframe['pose_' + str(int(PoseLandmark.RIGHT_HIP)) + '_y']) / 2.
-
-    # Select xy columns
-    centered_data = dataframe.copy()
-    centered_data[x_columns] = centered_data[x_columns] - \
-        dataframe['root_x'].to_numpy()[:, np.newaxis]
-    centered_data[y_columns] = centered_data[y_columns] - \
-        dataframe['root_y'].to_numpy()[:, np.newaxis]
-
-    # Replace left hand columns with the left wrist coordinates
-    no_left_hand_mask = np.all(centered_data[left_hand_columns].isna(), axis=1)
-    centered_data.loc[no_left_hand_mask, left_hand_columns] = np.tile(
-        centered_data.loc[no_left_hand_mask, left_wrist_columns], int(len(left_hand_columns) / 2))
-
-    # Replace right hand columns with the right wrist coordinates
-    no_right_hand_mask = np.all(
-        centered_data[right_hand_columns].isna(), axis=1)
-    centered_data.loc[no_right_hand_mask, right_hand_columns] = np.tile(
-        centered_data.loc[no_right_hand_mask, right_wrist_columns], int(len(right_hand_columns) / 2))
-
-    # Replace face columns with the nose coordinates
-    no_face_mask = np.all(centered_data[face_columns].isna(), axis=1)
-    centered_data.loc[no_face_mask, face_columns] = np.tile(
-        centered_data.loc[no_face_mask, nose_columns], int(len(face_columns) / 2))
+    # Compute root and midhip columns
+    root = compute_midpoint(data, xy_columns,
+                            'pose_' + str(int(PoseLandmark.LEFT_SHOULDER)),
+                            'pose_' + str(int(PoseLandmark.RIGHT_SHOULDER)))
+    midhip = compute_midpoint(data, xy_columns,
+                              'pose_' + str(int(PoseLandmark.LEFT_HIP)),
+                              'pose_' + str(int(PoseLandmark.RIGHT_HIP)))
+
+    # Center data
+    data[:, 0::2] -= root[:, 0:1]
+    data[:, 1::2] -= root[:, 1:2]
+
+    # Replace left hand columns with the left wrist coordinates,
+    # right hand columns with the right wrist coordinates
+    # and face columns with the nose coordinates
+    replace_nan_with_other_columns(data, xy_columns, [
+        (left_hand_columns, left_wrist_columns),
+        (right_hand_columns, right_wrist_columns),
+        (face_columns, nose_columns)
+    ])
 
     # Normalize data
-    repetitions = centered_data.groupby("video").size()
-    max_per_video = centered_data.abs().groupby(
-        "video")[xy_columns].max().max(axis=1)
-    max_per_video_repeated = max_per_video.repeat(
-        repetitions).to_numpy()[:, np.newaxis]
-    normalized_data = centered_data.copy()
-    normalized_data[xy_columns] = normalized_data[xy_columns] / \
-        max_per_video_repeated
+    scale_by_max_per_video(data, info["video"].to_numpy())
+
+    # Add root and midhip columns
+    data, columns = add_root_and_midhip(data, xy_columns,
+                                        root if with_root else None,
+                                        midhip if with_midhip else None)
 
-    return normalized_data
+    return join_dataframe(info, data, columns)
 
 
 def preprocess_dataframe_from0_to_1(dataframe, with_root=True, with_midhip=False):
-    x_columns = dataframe.columns[3::2]
-    y_columns = dataframe.columns[4::2]
-    xy_columns = dataframe.columns[3:]
+    info, data, xy_columns = split_dataframe(dataframe)
     left_hand_columns = [
-        column for column in dataframe.columns if "leftHand" in column]
+        column for column in xy_columns if "leftHand" in column]
     right_hand_columns = [
-        column for column in dataframe.columns if "rightHand" in column]
+        column for column in xy_columns if "rightHand" in column]
     left_wrist_columns = ['leftHand_' + str(int(PoseLandmark.LEFT_WRIST)) +
                           '_x', 'leftHand_' + str(int(PoseLandmark.LEFT_WRIST)) + '_y']
     right_wrist_columns = ['rightHand_' + str(int(PoseLandmark.RIGHT_WRIST)) +
                            '_x', 'rightHand_' + str(int(PoseLandmark.RIGHT_WRIST)) + '_y']
-    face_columns = [column for column in dataframe.columns if "face" in column]
+    face_columns = [column for column in xy_columns if "face" in column]
     nose_columns = ["pose_0_x", "pose_0_y"]
 
-    # Add root column
-    if with_root:
-        dataframe['root_x'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_SHOULDER)) + '_x'] +
-                               dataframe['pose_' + str(int(PoseLandmark.RIGHT_SHOULDER)) + '_x']) / 2.
-        dataframe['root_y'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_SHOULDER)) + '_y'] +
-                               dataframe['pose_' + str(int(PoseLandmark.RIGHT_SHOULDER)) + '_y']) / 2.
-
-    # Add midhip column
-    if with_midhip:
-        dataframe['midhip_x'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_HIP)) + '_x'] +
-                                 dataframe['pose_' + str(int(PoseLandmark.RIGHT_HIP)) + '_x']) / 2.
-        dataframe['midhip_y'] = (dataframe['pose_' + str(int(PoseLandmark.LEFT_HIP)) + '_y'] +
-                                 dataframe['pose_' + str(int(PoseLandmark.RIGHT_HIP)) + '_y']) / 2.
-
-    # Select xy columns
-    centered_data = dataframe.copy()
-    centered_data[x_columns] = centered_data[x_columns] - \
-        dataframe['root_x'].to_numpy()[:, np.newaxis]
-    centered_data[y_columns] = centered_data[y_columns] - \
-        dataframe['root_y'].to_numpy()[:, np.newaxis]
-
-    # Replace left hand columns with the left wrist coordinates
-    no_left_hand_mask = np.all(centered_data[left_hand_columns].isna(), axis=1)
-    centered_data.loc[no_left_hand_mask, left_hand_columns] = np.tile(
-        centered_data.loc[no_left_hand_mask, left_wrist_columns], int(len(left_hand_columns) / 2))
-
-    # Replace right hand columns with the right wrist coordinates
-    no_right_hand_mask = np.all(
-        centered_data[right_hand_columns].isna(), axis=1)
-    centered_data.loc[no_right_hand_mask, right_hand_columns] = np.tile(
-        centered_data.loc[no_right_hand_mask, right_wrist_columns], int(len(right_hand_columns) / 2))
-
-    # Replace face columns with the nose coordinates
-    no_face_mask = np.all(centered_data[face_columns].isna(), axis=1)
-    centered_data.loc[no_face_mask, face_columns] = np.tile(
-        centered_data.loc[no_face_mask, nose_columns], int(len(face_columns) / 2))
+    # Compute root and midhip columns
+    root = compute_midpoint(data, xy_columns,
+                            'pose_' + str(int(PoseLandmark.LEFT_SHOULDER)),
+                            'pose_' + str(int(PoseLandmark.RIGHT_SHOULDER)))
+    midhip = compute_midpoint(data, xy_columns,
+                              'pose_' + str(int(PoseLandmark.LEFT_HIP)),
+                              'pose_' + str(int(PoseLandmark.RIGHT_HIP)))
+
+    # Center data
+    data[:, 0::2] -= root[:, 0:1]
+    data[:, 1::2] -= root[:, 1:2]
+
+    # Replace left hand columns with the left wrist coordinates,
+    # right hand columns with the right wrist coordinates
+    # and face columns with the nose coordinates
+    replace_nan_with_other_columns(data, xy_columns, [
+        (left_hand_columns, left_wrist_columns),
+        (right_hand_columns, right_wrist_columns),
+        (face_columns, nose_columns)
+    ])
 
     # Move in the x-axis
-    x_coordinate_smaller_than_0_mask = np.any(
-        centered_data[x_columns] < 0, axis=1)
-    x_offset = centered_data[x_coordinate_smaller_than_0_mask][x_columns].min(
-        axis=1).abs().values[:, np.newaxis]
-    centered_data.loc[x_coordinate_smaller_than_0_mask,
-                      x_columns] = centered_data.loc[x_coordinate_smaller_than_0_mask, x_columns] + x_offset
+    x_coordinate_smaller_than_0_mask = np.any(data[:, 0::2] < 0, axis=1)
+    x_offset = np.abs(np.nanmin(
+        data[x_coordinate_smaller_than_0_mask, 0::2], axis=1))[:, np.newaxis]
+    data[x_coordinate_smaller_than_0_mask, 0::2] += x_offset
 
     # Move in the y-axis
-    y_coordinate_smaller_than_0_mask = np.any(
-        centered_data[y_columns] < 0, axis=1)
-    y_offset = centered_data[y_coordinate_smaller_than_0_mask][y_columns].min(
-        axis=1).abs().values[:, np.newaxis]
-    centered_data.loc[y_coordinate_smaller_than_0_mask,
-                      y_columns] = centered_data.loc[y_coordinate_smaller_than_0_mask, y_columns] + y_offset
+    y_coordinate_smaller_than_0_mask = np.any(data[:, 1::2] < 0, axis=1)
+    y_offset = np.abs(np.nanmin(
+        data[y_coordinate_smaller_than_0_mask, 1::2], axis=1))[:, np.newaxis]
+    data[y_coordinate_smaller_than_0_mask, 1::2] += y_offset
 
     # Normalize data
-    repetitions = centered_data.groupby("video").size()
-    max_per_video = centered_data.abs().groupby(
-        "video")[xy_columns].max().max(axis=1)
-    max_per_video_repeated = max_per_video.repeat(
-        repetitions).to_numpy()[:, np.newaxis]
-    normalized_data = centered_data.copy()
-    normalized_data[xy_columns] = normalized_data[xy_columns] / \
-        max_per_video_repeated
+    scale_by_max_per_video(data, info["video"].to_numpy())
+
+    # Add root and midhip columns
+    data, columns = add_root_and_midhip(data, xy_columns,
+                                        root if with_root else None,
+                                        midhip if with_midhip else None)
 
-    return normalized_data
+    return join_dataframe(info, data, columns)
 
 
 def preprocess_dataframe_legacy(dataframe, with_root=True, with_midhip=True):
@@ -166,21 +200,16 @@ def preprocess_dataframe_legacy(dataframe, with_root=True, with_midhip=True):
     # Select xy columns
     selected_data = dataframe.loc[:, xy_columns]
 
-    # Replace left hand columns with the left wrist coordinates
-    no_left_hand_mask = np.all(selected_data[left_hand_columns].isna(), axis=1)
-    selected_data.loc[no_left_hand_mask, left_hand_columns] = np.tile(
-        selected_data.loc[no_left_hand_mask, left_wrist_columns], int(len(left_hand_columns) / 2))
-
-    # Replace right hand columns with the right wrist coordinates
-    no_right_hand_mask = np.all(
-        selected_data[right_hand_columns].isna(), axis=1)
-    selected_data.loc[no_right_hand_mask, right_hand_columns] = np.tile(
-        selected_data.loc[no_right_hand_mask, right_wrist_columns], int(len(right_hand_columns) / 2))
-
-    # Replace face columns with the nose coordinates
-    no_face_mask = np.all(selected_data[face_columns].isna(), axis=1)
-    selected_data.loc[no_face_mask, face_columns] = np.tile(
-        selected_data.loc[no_face_mask, nose_columns], int(len(face_columns) / 2))
+    # Replace left hand columns with the left wrist coordinates,
+    # right hand columns with the right wrist coordinates
+    # and face columns with the nose coordinates
+    selected_values = selected_data.to_numpy(copy=True)
+    replace_nan_with_other_columns(selected_values, xy_columns, [
+        (left_hand_columns, left_wrist_columns),
+        (right_hand_columns, right_wrist_columns),
+        (face_columns, nose_columns)
+    ])
+    selected_data.loc[:, xy_columns] = selected_values
 
     # Move in the x-axis
     x_coordinate_smaller_than_0_mask = np.any(
@@ -225,6 +254,26 @@ def preprocess_dataframe_legacy(dataframe, with_root=True, with_midhip=True):
     return full_data
 
 
+def pad_or_resize_videos(stacked_images, video_lengths, frames=128):
+    # numpy counterpart of PadIfLessThan + ResizeIfMoreThan,
+    # applied once to every video of the stacked images
+    starts = np.concatenate([[0], np.cumsum(video_lengths)[:-1]])
+    videos = np.zeros((len(video_lengths), frames) + stacked_images.shape[1:],
+                      dtype=stacked_images.dtype)
+    for i, (start, length) in enumerate(zip(starts, video_lengths)):
+        video = stacked_images[start:start + length]
+        if length > frames:
+            # bilinear resize along the frames axis
+            # with half pixel centers (as tf.image.resize)
+            positions = (np.arange(frames) + 0.5) * (length / frames) - 0.5
+            lower = np.floor(positions).astype(np.int64)
+            upper = np.minimum(lower + 1, length - 1)
+            lerp = (positions - lower)[:, np.newaxis, np.newaxis]
+            video = video[lower] + (video[upper] - video[lower]) * lerp
+        videos[i, :min(length, frames)] = video
+    return videos
+
+
 class PadIfLessThan(tf.keras.layers.Layer):
     def __init__(self, frames=128, **kwargs):
         super().__init__(**kwargs)
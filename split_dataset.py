@@ -1,11 +1,11 @@
+import os
 import pandas as pd
 import tensorflow as tf
 from sklearn.model_selection import StratifiedKFold
-from config import INPUT_HEIGHT, INPUT_WIDTH, RANDOM_SEED
+from config import INPUT_HEIGHT, INPUT_WIDTH, MAX_BUFFER_SIZE, RANDOM_SEED
 from data_augmentation import RandomFlip, RandomScale, RandomShift, RandomRotation, RandomSpeed
-from preprocessing import PadIfLessThan, ResizeIfMoreThan, preprocess_dataframe
+from preprocessing import PadIfLessThan, ResizeIfMoreThan, pad_or_resize_videos, preprocess_dataframe
 from skeleton_graph import tssi_v2
-from sklearn.preprocessing import OneHotEncoder
 import numpy as np
 
 
@@ -20,58 +20,95 @@ available_augmentations = {
 augmentations_order_legacy = ['scale', 'shift', 'flip', 'rotation', 'speed']
 augmentations_order = ['flip', 'rotation', 'speed']
 
+# augmentations that map zero padding to zero padding
+# and are affine per joint (up to clipping), so they can be
+# applied after the linear resize along the frames
+padding_safe_augmentations = ['flip', 'rotation']
 
-def dataframe_to_dataset(dataframe, columns, filter_video_ids=[]):
+
+def dataframe_to_dataset(dataframe, columns, filter_video_ids=[], frames=None,
+                         shuffle=False):
     x_sorted_columns = [col + "_x" for col in columns]
     y_sorted_columns = [col + "_y" for col in columns]
 
-    enc = OneHotEncoder()
-
     if len(filter_video_ids) > 0:
         dataframe = dataframe[dataframe["video"].isin(filter_video_ids)]
 
-    dataframe_length = dataframe.shape[0]
     num_columns = len(x_sorted_columns)
-    stacked_images = np.zeros((dataframe_length, num_columns, 3))
-    stacked_images[:, :, 0] = dataframe.loc[:, x_sorted_columns].to_numpy()
-    stacked_images[:, :, 1] = dataframe.loc[:, y_sorted_columns].to_numpy()
-    video_labels = dataframe.groupby("video")["label"].unique().tolist()
-    video_lengths = list(dataframe.groupby("video")["frame"].count())
+    xy_sorted_columns = [column for pair in zip(
+        x_sorted_columns, y_sorted_columns) for column in pair]
+    # NOTE: the coordinates are stored as float16
+    # and cast to float32 in the map functions
+    xy = dataframe.loc[:, xy_sorted_columns] \
+        .to_numpy(dtype=np.float16) \
+        .reshape(-1, num_columns, 2)
+    stacked_images = np.concatenate(
+        [xy, np.zeros_like(xy[..., :1])], axis=-1)
+    _, first_indices, video_lengths = np.unique(
+        dataframe["video"].to_numpy(), return_index=True, return_counts=True)
+    video_labels = pd.Categorical(dataframe["label"].to_numpy()[first_indices])
+
+    # if frames is provided, normalize the length of the videos
+    # beforehand instead of building a ragged tensor
+    if frames is None:
+        row_splits = np.concatenate([[0], np.cumsum(video_lengths)])
+        X = tf.RaggedTensor.from_row_splits(
+            values=tf.constant(stacked_images),
+            row_splits=tf.constant(row_splits, dtype=tf.int64))
+    else:
+        X = pad_or_resize_videos(stacked_images, video_lengths, frames)
+    y = tf.one_hot(video_labels.codes, len(video_labels.categories))
 
-    X = tf.RaggedTensor.from_row_lengths(
-        values=stacked_images, row_lengths=video_lengths)
-    y = enc.fit_transform(video_labels).toarray()
+    # shuffle the videos once beforehand
+    if shuffle:
+        permutation = np.random.default_rng(
+            RANDOM_SEED).permutation(len(video_lengths))
+        X = tf.gather(X, permutation)
+        y = tf.gather(y, permutation)
 
     dataset = tf.data.Dataset.from_tensor_slices((X, y))
 
     return dataset
 
 
-def generate_train_dataset(dataframe,
-                           columns,
-                           video_ids,
+def get_dataset_options():
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.noop_elimination = True
+    options.experimental_optimization.parallel_batch = True
+    options.threading.private_threadpool_size = os.cpu_count()
+    return options
+
+
+def generate_train_dataset(ds,
                            train_map_fn,
                            repeat=False,
                            batch_size=32,
                            buffer_size=5000,
                            deterministic=False):
-    # convert dataframe to dataset
-    ds = dataframe_to_dataset(dataframe, columns, video_ids)
-
-    # shuffle, map and batch dataset
+    # NOTE: the shuffle buffer is capped, since the videos
+    # were already shuffled once when converting the dataframe
+    ds = ds.shuffle(min(buffer_size, MAX_BUFFER_SIZE),
+                    reshuffle_each_iteration=True)
+
+    # map and batch dataset
+    # NOTE: the augmentation layers draw their parameters once per call,
+    # so the map function runs once per example
+    # NOTE: the map is serial when deterministic, since the
+    # augmentation layers use stateful seeded random ops
     if deterministic:
-        train_dataset = ds \
-            .shuffle(buffer_size) \
-            .map(train_map_fn) \
-            .batch(batch_size)
+        ds = ds.map(train_map_fn)
     else:
-        train_dataset = ds \
-            .shuffle(buffer_size) \
-            .map(train_map_fn,
-                 num_parallel_calls=tf.data.AUTOTUNE,
-                 deterministic=False) \
-            .batch(batch_size) \
-            .prefetch(tf.data.AUTOTUNE)
+        ds = ds.map(train_map_fn,
+                    num_parallel_calls=tf.data.AUTOTUNE,
+                    deterministic=False)
+    train_dataset = ds \
+        .batch(batch_size) \
+        .prefetch(tf.data.AUTOTUNE)
+
+    # enable the static optimizations
+    train_dataset = train_dataset.with_options(get_dataset_options())
 
     if repeat:
         train_dataset = train_dataset.repeat()
@@ -79,31 +116,39 @@ def generate_train_dataset(dataframe,
     return train_dataset
 
 
-def generate_test_dataset(dataframe,
-                          columns,
-                          video_ids,
+def ragged_to_dense(x, y):
+    # the examples are sliced from a ragged tensor as
+    # ragged values, which padded batching does not accept
+    if isinstance(x, tf.RaggedTensor):
+        x = x.to_tensor()
+    return x, y
+
+
+def generate_test_dataset(ds,
+                          max_element_length,
                           test_map_fn,
                           batch_size=32):
-    # convert dataframe to dataset
-    ds = dataframe_to_dataset(dataframe, columns, video_ids)
+    # densify the examples
+    ds = ds.map(ragged_to_dense, num_parallel_calls=tf.data.AUTOTUNE)
 
     # batch dataset
-    max_element_length = dataframe \
-        .groupby("video").size().max()
     bucket_boundaries = list(range(1, max_element_length))
     bucket_batch_sizes = [batch_size] * max_element_length
     ds = ds.bucket_by_sequence_length(
         element_length_func=lambda x, y: tf.shape(x)[0],
         bucket_boundaries=bucket_boundaries,
-        bucket_batch_sizes=bucket_batch_sizes,
-        no_padding=True)
+        bucket_batch_sizes=bucket_batch_sizes)
 
     # map dataset
     dataset = ds \
         .map(test_map_fn,
              num_parallel_calls=tf.data.AUTOTUNE,
              deterministic=False) \
-        .cache()
+        .cache() \
+        .prefetch(tf.data.AUTOTUNE)
+
+    # enable the static optimizations
+    dataset = dataset.with_options(get_dataset_options())
 
     return dataset
 
@@ -137,6 +182,8 @@ class SplitDataset():
         splits = list(
             skf.split(np.zeros(num_total_examples), labels))
         num_train_examples = len(splits[0][0])
+        max_element_length = main_dataframe \
+            .groupby("video").size().max()
 
         # expose variables
         self.joints_order = joints_order
@@ -145,12 +192,27 @@ class SplitDataset():
         self.labels = labels
         self.splits = splits
         self.num_train_examples = num_train_examples
+        self.max_element_length = max_element_length
+
+        # converted datasets,
+        # keyed by (video ids, frames, shuffle)
+        self.converted_datasets = {}
 
         # free memory
         del train_dataframe
         del validation_dataframe
         del train_and_validation_dataframe
 
+    def get_converted_dataset(self, video_ids, frames=None, shuffle=False):
+        # convert the dataframe only once
+        # for each set of video ids
+        key = (tuple(video_ids), frames, shuffle)
+        if key not in self.converted_datasets:
+            self.converted_datasets[key] = dataframe_to_dataset(
+                self.main_dataframe, self.joints_order, video_ids,
+                frames=frames, shuffle=shuffle)
+        return self.converted_datasets[key]
+
     def get_training_set(self, split=1, batch_size=32,
                          buffer_size=5000, repeat=False,
                          deterministic=False, augmentations=None):
@@ -185,19 +247,36 @@ class SplitDataset():
         layers = [available_augmentations[aug] for aug in augmentations]
         train_augmentation = tf.keras.Sequential(layers, name="augmentation")
 
+        # the length of the samples can be normalized a priori
+        # only if all the augmentations are padding-safe
+        if all(aug in padding_safe_augmentations for aug in augmentations):
+            frames = INPUT_HEIGHT
+        else:
+            frames = None
+
         # define the train map function
-        @tf.function
+        # NOTE: it is compiled with XLA only when the samples
+        # have a fixed length, since the ragged samples
+        # (and random speed augmentation) have data-dependent lengths
+        # NOTE: missing joints are moved to the origin (the root)
+        # beforehand, since clipping maps NaN to -1 under XLA
+        @tf.function(jit_compile=frames is not None)
         def train_map_fn(x, y):
+            x = tf.cast(x, tf.float32)
+            x = tf.where(tf.math.is_nan(x), 0., x)
             batch = tf.expand_dims(x, axis=0)
             # batch = train_preprocessing(batch)
             batch = train_augmentation(batch, training=True)
-            x = train_length_normalization(batch)[0]
+            if frames is None:
+                batch = train_length_normalization(batch)
+            x = batch[0]
             x = tf.ensure_shape(x, [INPUT_HEIGHT, INPUT_WIDTH, 3])
             return x, y
 
-        dataset = generate_train_dataset(self.main_dataframe,
-                                         self.joints_order,
-                                         train_indices,
+        ds = self.get_converted_dataset(train_indices,
+                                        frames=frames,
+                                        shuffle=True)
+        dataset = generate_train_dataset(ds,
                                          train_map_fn,
                                          repeat=repeat,
                                          batch_size=batch_size,
@@ -219,15 +298,18 @@ class SplitDataset():
         ], name="preprocessing")
 
         # define the train map function
+        # NOTE: missing joints are moved to the origin (the root)
+        # as in the train map function
         @tf.function
         def test_map_fn(x, y):
-            x = x.to_tensor()
+            x = tf.cast(x, tf.float32)
+            x = tf.where(tf.math.is_nan(x), 0., x)
             x = test_preprocessing(x)
             return x, y
 
-        dataset = generate_test_dataset(self.main_dataframe,
-                                        self.joints_order,
-                                        val_indices,
+        ds = self.get_converted_dataset(val_indices)
+        dataset = generate_test_dataset(ds,
+                                        self.max_element_length,
                                         test_map_fn,
                                         batch_size=batch_size)
 